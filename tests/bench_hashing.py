@@ -0,0 +1,119 @@
+"""
+Login throughput against page latency during a login rush. LOGINS staff
+log in through CONCURRENCY client threads against a threaded server while
+a probe keeps loading the login page; compare --workers 0 (hashing inline
+in the request threads) with the default process pool.
+
+    python tests/bench_hashing.py
+    python tests/bench_hashing.py --workers 0 --logins 60
+
+Not collected by pytest; the database is a throwaway file in a temp dir.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--logins", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=20, help="client threads logging in at once")
+    parser.add_argument("--workers", type=int, help="HMS_HASH_WORKERS; 0 hashes in the request thread")
+    args = parser.parse_args()
+
+    # Read once at import, so set before importing the app
+    work_dir = tempfile.mkdtemp(prefix="hms-bench-")
+    os.environ.setdefault("HMS_DATABASE_URL", f"sqlite:///{os.path.join(work_dir, 'bench.db')}")
+    os.environ.setdefault("HMS_TEMPLATE_CACHE", "0")
+    if args.workers is not None:
+        os.environ["HMS_HASH_WORKERS"] = str(args.workers)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as hms
+    from werkzeug.security import generate_password_hash
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    hms.create_app()
+    hms.initialize_app()
+    session = hms.SessionLocal()
+    try:
+        # Hashed at the current cost policy, so no login triggers a rehash
+        password = generate_password_hash("pw", method=hms.PASSWORD_HASH_METHOD)
+        session.add_all(
+            hms.User(username=f"staff{i}", password=password, name=f"Staff {i}", role="admin")
+            for i in range(args.logins)
+        )
+        session.commit()
+    finally:
+        session.close()
+
+    server = make_server("127.0.0.1", 0, hms.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    def login(i):
+        opener = urllib.request.build_opener(NoRedirect)
+        data = urllib.parse.urlencode({"username": f"staff{i}", "password": "pw"}).encode()
+        started = perf_counter()
+        try:
+            status = opener.open(base + "/login", data, timeout=120).status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        return status, perf_counter() - started
+
+    def load_page():
+        started = perf_counter()
+        urllib.request.urlopen(base + "/login", timeout=120).read()
+        return perf_counter() - started
+
+    idle = [load_page() for _ in range(20)]
+    busy, done = [], threading.Event()
+
+    def probe():
+        while not done.is_set():
+            busy.append(load_page())
+            sleep(0.02)
+
+    prober = threading.Thread(target=probe)
+    prober.start()
+    started = perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(login, range(args.logins)))
+    wall = perf_counter() - started
+    done.set()
+    prober.join()
+    server.shutdown()
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    print(f"hash workers {hms.HASH_WORKERS}, {args.logins} logins by {args.concurrency} clients: "
+          f"{args.logins / wall:.1f} logins/s, login p50 {percentile([s for _, s in results], .5):.0f} ms, "
+          f"statuses {statuses}")
+    print(f"login page p50 idle {percentile(idle, .5):.1f} ms, during the rush p50 {percentile(busy, .5):.1f} ms "
+          f"p95 {percentile(busy, .95):.1f} ms max {max(busy) * 1000:.0f} ms ({len(busy)} loads)")
+    print(f"hashing stats {hms.HASH_STATS}")
+
+
+if __name__ == "__main__":
+    main()
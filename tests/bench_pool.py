@@ -0,0 +1,115 @@
+"""
+Requests per second on the booking and patient dashboard routes under a
+given engine setup: pool size, SQL echo and the SQLite connection pragmas.
+CLIENTS patients each book REQUESTS appointments with their own doctor and
+then load their dashboard REQUESTS times, one test client per thread.
+Keep CLIENTS at or below the pool size, as with request threads.
+
+    python tests/bench_pool.py                          # current defaults
+    python tests/bench_pool.py --echo --no-pragmas      # the setup before
+    python tests/bench_pool.py --clients 4 --pool-size 4
+
+Not collected by pytest; the database is a throwaway file in a temp dir.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+from datetime import date, timedelta
+from time import perf_counter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=300, help="bookings and dashboard loads per client")
+    parser.add_argument("--clients", type=int, default=1, help="patients sending requests at once")
+    parser.add_argument("--pool-size", type=int, help="HMS_DB_POOL_SIZE")
+    parser.add_argument("--echo", action="store_true", help="log every statement, as HMS_SQL_ECHO=1 does")
+    parser.add_argument("--no-pragmas", action="store_true", help="open SQLite connections with its defaults")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="hms-bench-")
+    os.environ.setdefault("HMS_TEMPLATE_CACHE", "0")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as hms
+    from werkzeug.security import generate_password_hash
+
+    if args.no_pragmas:
+        hms.SQLITE_PRAGMAS.clear()
+    config = {
+        "DATABASE_URL": f"sqlite:///{os.path.join(work_dir, 'bench.db')}",
+        "SQL_ECHO": args.echo,
+        "DB_POOL_SIZE": hms.DB_POOL_SIZE if args.pool_size is None else args.pool_size,
+    }
+    hms.create_app(config)
+    hms.initialize_app()
+    # Echo still formats every statement; only the terminal is spared
+    devnull = open(os.devnull, "w")
+    for handler in logging.getLogger("sqlalchemy.engine.Engine").handlers:
+        handler.setStream(devnull)
+
+    session = hms.SessionLocal()
+    try:
+        # One iteration, so logging in costs nothing next to the requests
+        password = generate_password_hash("pw", method="pbkdf2:sha256:1")
+        for i in range(args.clients):
+            doctor = hms.User(username=f"doc{i}", password=password, name=f"Dr {i}", role="doctor")
+            patient = hms.User(username=f"pat{i}", password=password, name=f"Patient {i}", role="patient")
+            session.add_all([doctor, patient])
+            session.flush()
+            session.add_all([
+                hms.Doctor(uid=doctor.id, depid=1, license_number=f"LIC{i:05d}", status="active"),
+                hms.Patient(uid=patient.id),
+            ])
+        session.commit()
+        doctor_ids = [row.id for row in session.query(hms.Doctor.id).order_by(hms.Doctor.id)]
+    finally:
+        session.close()
+
+    clients = []
+    for i in range(args.clients):
+        client = hms.app.test_client()
+        client.post("/login", data={"username": f"pat{i}", "password": "pw"})
+        clients.append(client)
+
+    def book(i):
+        client, doctor_id = clients[i], str(doctor_ids[i])
+        for n in range(args.requests):
+            day = date.today() + timedelta(days=1 + n // 20)
+            client.post("/patient/appointments/book", data={
+                "doctor_id": doctor_id,
+                "appoint_date": day.isoformat(),
+                "appoint_time": f"{8 + (n % 20) // 2:02d}:{30 * (n % 2):02d}",
+                "reason": "Check-up",
+            })
+
+    def dashboard(i):
+        for _ in range(args.requests):
+            clients[i].get("/patient/dashboard")
+
+    def run(target):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(args.clients)]
+        started = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return args.clients * args.requests / (perf_counter() - started)
+
+    booking_rps = run(book)
+    dashboard_rps = run(dashboard)
+    session = hms.SessionLocal()
+    try:
+        booked = session.query(hms.Appointment).count()
+    finally:
+        session.close()
+
+    setup = f"pool {config['DB_POOL_SIZE']}, echo {'on' if args.echo else 'off'}, " \
+            f"pragmas {'off' if args.no_pragmas else 'on'}, {args.clients} client(s)"
+    print(f"{setup}: booking {booking_rps:.0f} req/s ({booked} booked), dashboard {dashboard_rps:.0f} req/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Admin search latency at scale: the FTS5 index against the substring
+(ilike '%term%') matching it replaced, on a database of ROWS patients
+and ROWS appointments with 500 doctors.
+
+    python tests/bench_search.py              # 1M patients, a few minutes
+    python tests/bench_search.py --rows 50000
+
+Not collected by pytest; the database is a throwaway file in a temp dir.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+WORK_DIR = tempfile.mkdtemp(prefix="hms-bench-")
+os.environ.setdefault("HMS_DATABASE_URL", f"sqlite:///{os.path.join(WORK_DIR, 'bench.db')}")
+os.environ.setdefault("HMS_TEMPLATE_CACHE", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as hms  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+DOCTORS = 500
+BATCH = 50_000
+FIRST_NAMES = ["Alice", "Bob", "Carol", "David", "Eve", "Frank", "Grace", "Heidi", "Ivan", "Judy",
+               "Mallory", "Niaj", "Olivia", "Peggy", "Rupert", "Sybil", "Trent", "Victor", "Walter", "Zara"]
+SURNAMES = [f"Surname{i}" for i in range(5000)]
+# (kind, term): a rare surname, a two-word name, a username, a license
+# number, an appointment number and appointments by patient name
+TERMS = [
+    ("patient", "Surname4242"),
+    ("patient", "zara surname12"),
+    ("patient", "user99999"),
+    ("doctor", "LIC00042"),
+    ("appointment", "APT-0000500"),
+    ("appointment", "Surname4242"),
+]
+
+
+def batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load(rows):
+    rnd = random.Random(1)
+
+    def name():
+        return f"{rnd.choice(FIRST_NAMES)} {rnd.choice(SURNAMES)}"
+
+    tables = [
+        (hms.User, ({"id": i, "username": f"user{i}", "password": "-", "name": name(), "role": "patient"}
+                    for i in range(1, rows + 1))),
+        (hms.Patient, ({"id": i, "uid": i, "gender": "F", "blood_group": rnd.choice(["O+", "A-", "B+", "AB-"])}
+                       for i in range(1, rows + 1))),
+        (hms.User, ({"id": rows + i, "username": f"doc{i}", "password": "-", "name": f"Dr {name()}", "role": "doctor"}
+                    for i in range(1, DOCTORS + 1))),
+        (hms.Doctor, ({"id": i, "uid": rows + i, "depid": 1 + i % 5, "license_number": f"LIC{i:05d}",
+                       "specialization": "Cardiology", "status": "active"} for i in range(1, DOCTORS + 1))),
+        (hms.Appointment, ({"id": i, "appointment_number": f"APT-{i:07d}", "patid": rnd.randint(1, rows),
+                            "docid": rnd.randint(1, DOCTORS), "status": "Booked"} for i in range(1, rows + 1))),
+    ]
+    with hms.engine.begin() as conn:
+        for model, generated in tables:
+            for batch in batches(generated):
+                conn.execute(insert(model.__table__), batch)
+
+
+def best_ms(function, repeat):
+    """Fastest of repeat calls, in ms, and the last result."""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = perf_counter()
+        result = function()
+        best = min(best, perf_counter() - started)
+    return best * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=1_000_000, help="patients and appointments to load")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per search; the fastest counts")
+    args = parser.parse_args()
+
+    hms.create_app()
+    hms.Base.metadata.create_all(hms.engine)
+    hms.create_standard_departments()
+
+    started = perf_counter()
+    load(args.rows)
+    print(f"loaded {args.rows} patients and appointments in {perf_counter() - started:.1f} s")
+    started = perf_counter()
+    hms.create_search_index(hms.engine)
+    print(f"built the FTS5 index in {perf_counter() - started:.1f} s")
+
+    session = hms.SessionLocal()
+    try:
+        for kind, term in TERMS:
+            fts_ms, found = best_ms(lambda: hms.search_records(session, kind, term), args.repeat)
+            like_ms, matched = best_ms(
+                lambda: hms._search_records_like(session, kind, term, hms.SEARCH_LIMIT), min(args.repeat, 2)
+            )
+            print(f"{kind:12s} {term!r:18s} ilike {like_ms:9.1f} ms ({len(matched)} rows)   "
+                  f"fts5 {fts_ms:7.1f} ms ({len(found)} rows)")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import sys
+import tempfile
+from datetime import date, time, timedelta
+
+import pytest
+
+# app binds its engine at import; keep it away from the working hms.db
+os.environ.setdefault("HMS_DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "hms.db"))
+os.environ.setdefault("HMS_HASH_WORKERS", "0")
+os.environ.setdefault("HMS_TEMPLATE_CACHE", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as hms  # noqa: E402
+
+PASSWORD = "pw"
+
+
+@pytest.fixture
+def fresh_app(tmp_path, monkeypatch):
+    """Return a factory that points the app at a new, initialized database."""
+    counter = iter(range(1000))
+
+    def build():
+        hms.create_app({"DATABASE_URL": f"sqlite:///{tmp_path}/hms{next(counter)}.db", "TESTING": True})
+        # Process-wide caches keyed by ids that the new database reuses
+        monkeypatch.setattr(hms, "identity_cache", hms.IdentityCache())
+        monkeypatch.setattr(hms.appointment_numbers, "_end", 0)
+        hms.doctor_directory.invalidate()
+        hms.initialize_app()
+        return hms
+
+    return build
+
+
+@pytest.fixture
+def seed():
+    """Return a function that fills the current database with test data."""
+
+    def fill(doctors=3, patients=5, appointments=10):
+        """Create users doc0.., pat0.. (password "pw") and spread appointments over them."""
+        session = hms.SessionLocal()
+        try:
+            password = hms.hash_password(PASSWORD)
+            departments = [d.id for d in session.query(hms.Department).order_by(hms.Department.id)]
+            doctor_rows, patient_rows = [], []
+            for i in range(doctors):
+                user = hms.User(username=f"doc{i}", password=password, name=f"Doctor {i}", role="doctor")
+                session.add(user)
+                session.flush()
+                doctor = hms.Doctor(
+                    uid=user.id, depid=departments[i % len(departments)], license_number=f"LIC{i:05d}",
+                    specialization="Cardiology", qualification="MBBS", experience=5, gender="M",
+                )
+                session.add(doctor)
+                doctor_rows.append(doctor)
+            for i in range(patients):
+                user = hms.User(username=f"pat{i}", password=password, name=f"Patient {i}", role="patient")
+                session.add(user)
+                session.flush()
+                patient = hms.Patient(uid=user.id, gender="F", dob=date(1990, 1, 1), blood_group="O+", address="Street 1")
+                session.add(patient)
+                patient_rows.append(patient)
+            session.flush()
+
+            today = date.today()
+            for i in range(appointments):
+                status = ("Booked", "Completed", "Cancelled")[i % 3]
+                appointment = hms.Appointment(
+                    appointment_number=f"APT-{i + 1:04d}",
+                    patid=patient_rows[i % patients].id,
+                    docid=doctor_rows[i % doctors].id,
+                    appoint_date=today + timedelta(days=i % 10 - 5),
+                    appoint_time=time(9 + i % 8, 0),
+                    status=status,
+                    reason_for_visit="Checkup",
+                )
+                session.add(appointment)
+                session.flush()
+                if status == "Completed":
+                    session.add(hms.Treatment(
+                        appointid=appointment.id, docid=appointment.docid, patid=appointment.patid,
+                        diagnosis="Flu", treatment_plan="Rest", prescription="Water",
+                    ))
+            hms.bump_reference_version(session, "doctors", "patients")
+            session.commit()
+            hms.reconcile_counters(session)
+            hms.backfill_slots(session)
+            return [d.id for d in doctor_rows], [p.id for p in patient_rows]
+        finally:
+            session.close()
+
+    return fill
+
+
+@pytest.fixture
+def login():
+    """Return a function giving a test client logged in as username."""
+
+    def client(username, password=PASSWORD):
+        test_client = hms.app.test_client()
+        response = test_client.post("/login", data={"username": username, "password": password})
+        assert response.status_code == 302, f"login as {username} failed"
+        return test_client
+
+    return client
@@ -0,0 +1,42 @@
+from sqlalchemy import event
+
+from conftest import hms
+
+
+def test_list_etag_is_checked_before_rows_are_loaded(fresh_app, seed, login):
+    fresh_app()
+    seed(doctors=2, patients=3, appointments=12)
+    admin = login("admin", "admin123")
+    url = f"{hms.API_PREFIX}/appointments"
+
+    first = admin.get(url, query_string={"per_page": 5})
+    assert first.status_code == 200 and first.headers["ETag"]
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(hms.engine, "before_cursor_execute", record)
+    try:
+        repeat = admin.get(url, query_string={"per_page": 5}, headers={"If-None-Match": first.headers["ETag"]})
+    finally:
+        event.remove(hms.engine, "before_cursor_execute", record)
+    assert repeat.status_code == 304
+    # Only the max(updated_at) stamp ran, never the page itself
+    assert not [s for s in statements if "LIMIT" in s.upper()]
+
+    # Another page is a different response
+    other = admin.get(url, query_string={"per_page": 6}, headers={"If-None-Match": first.headers["ETag"]})
+    assert other.status_code == 200
+
+    session = hms.SessionLocal()
+    try:
+        appointment = session.query(hms.Appointment).order_by(hms.Appointment.id).first()
+        appointment.reason_for_visit = "Follow-up"
+        session.commit()
+    finally:
+        session.close()
+    changed = admin.get(url, query_string={"per_page": 5}, headers={"If-None-Match": first.headers["ETag"]})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != first.headers["ETag"]
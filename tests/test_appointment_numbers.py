@@ -0,0 +1,92 @@
+"""
+Stress test for appointment_numbers: several processes, each with several
+threads, allocate from one file-backed SQLite database with a small block
+size so they keep contending for new blocks. No number may repeat.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from conftest import hms
+
+PROCESSES = 4
+THREADS = 8
+PER_THREAD = 50
+BLOCK_SIZE = 3
+
+
+def allocate_in_threads(database_url=None):
+    """Numbers handed out by THREADS threads of this process."""
+    if database_url is not None:
+        # A spawned worker: bind the module engine to the shared database
+        hms.create_app({"DATABASE_URL": database_url})
+    hms.appointment_numbers.block_size = BLOCK_SIZE
+    numbers, errors = [], []
+    start = threading.Barrier(THREADS)
+
+    def work():
+        try:
+            start.wait()
+            mine = [hms.appointment_numbers.next() for _ in range(PER_THREAD)]
+        except Exception as e:
+            errors.append(e)
+            return
+        numbers.extend(mine)
+
+    threads = [threading.Thread(target=work) for _ in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return numbers
+
+
+def test_numbers_are_unique_across_threads_and_processes(fresh_app, monkeypatch):
+    fresh_app()
+    monkeypatch.setattr(hms.appointment_numbers, "block_size", BLOCK_SIZE)
+    database_url = hms.engine.url.render_as_string(hide_password=False)
+
+    # spawn, not fork: each worker imports the app and opens its own pool
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(PROCESSES, mp_context=context) as pool:
+        futures = [pool.submit(allocate_in_threads, database_url) for _ in range(PROCESSES)]
+        local = allocate_in_threads()
+        numbers = local + [number for future in futures for number in future.result()]
+
+    assert len(numbers) == (PROCESSES + 1) * THREADS * PER_THREAD
+    duplicates = len(numbers) - len(set(numbers))
+    assert not duplicates, f"{duplicates} appointment numbers handed out twice"
+    assert min(numbers) == 1
+    # The shared sequence row is past every number handed out
+    assert hms.appointment_numbers.current() >= max(numbers)
+
+
+def test_seed_skips_numbers_that_are_not_digits(fresh_app, seed):
+    fresh_app()
+    (doctor_id, *_), (patient_id, *_) = seed(doctors=1, patients=1, appointments=0)
+    numbers = ["APT-0007", "APT-0100", "APT-12abc", "APTX", "APT-", "WALKIN-5", "APT-" + "9" * 30]
+    session = hms.SessionLocal()
+    try:
+        session.add_all(
+            hms.Appointment(appointment_number=number, docid=doctor_id, patid=patient_id) for number in numbers
+        )
+        session.commit()
+    finally:
+        session.close()
+    with hms.engine.connect() as conn:
+        assert hms.max_appointment_number(conn) == 100
+
+
+def test_reservation_inside_a_request_with_a_pool_of_one(fresh_app, tmp_path):
+    fresh_app()
+    hms.create_app({"DATABASE_URL": f"sqlite:///{tmp_path}/pool1.db", "DB_POOL_SIZE": 1})
+    hms.initialize_app()
+    session = hms.SessionLocal()
+    try:
+        # Held for the request, as checkout_db_connection does
+        session.connection()
+        assert hms.appointment_numbers.next() == 1
+    finally:
+        session.close()
@@ -0,0 +1,122 @@
+from datetime import date, time, timedelta
+
+from conftest import hms
+
+
+def next_weekday(weekday):
+    today = date.today()
+    return today + timedelta(days=(weekday - today.weekday()) % 7 or 7)
+
+
+def materialized(doctor_id):
+    """(availability rows, free slot rows) the doctor has from today on."""
+    session = hms.SessionLocal()
+    try:
+        today = date.today()
+        rows = session.query(hms.DoctorAvailability).filter(
+            hms.DoctorAvailability.docid == doctor_id, hms.DoctorAvailability.available_date >= today
+        ).count()
+        free = session.query(hms.AppointmentSlot).filter(
+            hms.AppointmentSlot.docid == doctor_id,
+            hms.AppointmentSlot.slot_date >= today,
+            hms.AppointmentSlot.appointid.is_(None),
+        ).count()
+        return rows, free
+    finally:
+        session.close()
+
+
+def available(doctor_id, day, at):
+    session = hms.SessionLocal()
+    try:
+        return hms.check_doctor_availability(session, doctor_id, day, at)[0]
+    finally:
+        session.close()
+
+
+def test_deleting_leave_restores_day_without_rules(fresh_app, seed, login):
+    fresh_app()
+    (doctor_id, *_), _ = seed(appointments=0)
+    doctor = login("doc0")
+    day = next_weekday(1)
+
+    doctor.post("/doctor/availability", data={"action": "exception", "kind": "leave", "start_date": day.isoformat()})
+    assert not available(doctor_id, day, time(10))
+
+    session = hms.SessionLocal()
+    exception_id = session.query(hms.AvailabilityException.id).filter_by(docid=doctor_id).scalar()
+    session.close()
+    doctor.post("/doctor/availability", data={"action": "delete_exception", "exception_id": str(exception_id)})
+    assert available(doctor_id, day, time(10))
+    assert materialized(doctor_id) == (0, 0)
+
+
+def test_clearing_weekly_rules_reopens_every_day(fresh_app, seed, login):
+    fresh_app()
+    (doctor_id, *_), _ = seed(appointments=0)
+    doctor = login("doc0")
+    tuesday = next_weekday(1)
+
+    doctor.post("/doctor/availability", data={"action": "weekly", "windows_0": "09:00-12:00"})
+    assert not available(doctor_id, tuesday, time(10))
+    assert materialized(doctor_id) != (0, 0)
+
+    doctor.post("/doctor/availability", data={"action": "weekly"})
+    assert available(doctor_id, tuesday, time(10))
+    assert materialized(doctor_id) == (0, 0)
+
+
+def test_rematerializing_keeps_booked_slots(fresh_app, seed, login):
+    fresh_app()
+    (doctor_id, *_), _ = seed(appointments=0)
+    doctor, patient = login("doc0"), login("pat0")
+    monday = next_weekday(0)
+
+    doctor.post("/doctor/availability", data={"action": "weekly", "windows_0": "09:00-12:00"})
+    patient.post("/patient/appointments/book", data={
+        "doctor_id": str(doctor_id), "appoint_date": monday.isoformat(), "appoint_time": "10:00", "reason": "Checkup",
+    })
+    doctor.post("/doctor/availability", data={"action": "weekly"})
+
+    session = hms.SessionLocal()
+    try:
+        slot = session.query(hms.AppointmentSlot).filter_by(docid=doctor_id, slot_date=monday, slot_time=time(10)).one()
+        assert slot.appointid is not None
+    finally:
+        session.close()
+
+
+def test_hand_entered_days_survive_rematerializing(fresh_app, seed, login):
+    fresh_app()
+    (doctor_id, *_), _ = seed(appointments=0)
+    doctor = login("doc0")
+    hand_entered, leave = next_weekday(2), next_weekday(3)
+
+    session = hms.SessionLocal()
+    try:
+        session.add(hms.DoctorAvailability(
+            docid=doctor_id, available_date=hand_entered, start_time=time(9), end_time=time(11), available=True,
+        ))
+        hms.materialize_slots(session, doctor_id, hand_entered, time(9), time(11))
+        session.commit()
+    finally:
+        session.close()
+    assert not available(doctor_id, hand_entered, time(14))
+
+    # Leave on another day, deleted again, then the nightly horizon roll
+    doctor.post("/doctor/availability", data={"action": "exception", "kind": "leave", "start_date": leave.isoformat()})
+    session = hms.SessionLocal()
+    exception_id = session.query(hms.AvailabilityException.id).filter_by(docid=doctor_id).scalar()
+    session.close()
+    doctor.post("/doctor/availability", data={"action": "delete_exception", "exception_id": str(exception_id)})
+    session = hms.SessionLocal()
+    try:
+        hms.materialize_schedule(session, doctor_id)
+        session.commit()
+    finally:
+        session.close()
+
+    assert available(doctor_id, hand_entered, time(10))
+    assert not available(doctor_id, hand_entered, time(14))
+    assert available(doctor_id, leave, time(10))
+    assert materialized(doctor_id)[0] == 1
@@ -0,0 +1,25 @@
+from conftest import hms
+
+
+def test_doctor_cannot_revalidate_another_doctors_appointment(fresh_app, seed, login):
+    fresh_app()
+    seed(doctors=2, patients=2, appointments=4)
+    session = hms.SessionLocal()
+    try:
+        mine, theirs = (
+            session.query(hms.Appointment.id).join(hms.Doctor).join(hms.User)
+            .filter(hms.User.username == username).order_by(hms.Appointment.id).first()[0]
+            for username in ("doc0", "doc1")
+        )
+    finally:
+        session.close()
+    doctor = login("doc0")
+    doctor.get("/doctor/dashboard")  # shows the login flash
+
+    own = doctor.get(f"/doctor/appointment/view/{mine}")
+    assert own.status_code == 200
+    assert doctor.get(f"/doctor/appointment/view/{mine}", headers={"If-None-Match": own.headers["ETag"]}).status_code == 304
+
+    other = doctor.get(f"/doctor/appointment/view/{theirs}")
+    # Turned away before any validator is issued, so none can be replayed
+    assert other.status_code == 302 and "ETag" not in other.headers
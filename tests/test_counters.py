@@ -0,0 +1,28 @@
+from conftest import hms
+
+
+def test_counters_are_created_and_moved_by_upsert(fresh_app, seed):
+    fresh_app()
+    (doctor_id, *_), (patient_id, *_) = seed(doctors=1, patients=1, appointments=0)
+
+    session = hms.SessionLocal()
+    try:
+        appointment = hms.Appointment(appointment_number="APT-9001", docid=doctor_id, patid=patient_id, status="Booked")
+        session.add(appointment)
+        session.flush()
+        hms.count_status_change(session, appointment, None, "Booked")
+        hms.count_status_change(session, appointment, "Booked", "Completed")
+        hms.count_status_change(session, appointment, None, "Booked")
+        session.commit()
+
+        for scope, scope_id in (("hospital", 0), ("doctor", doctor_id), ("patient", patient_id)):
+            assert hms.read_counters(session, scope, scope_id) == {"Booked": 1, "Completed": 1}
+
+        before = hms.reference_versions(session).get("departments", 0)
+        hms.bump_reference_version(session, "departments", "brand_new")
+        session.commit()
+        versions = dict(session.query(hms.ReferenceVersion.name, hms.ReferenceVersion.version).all())
+        assert versions["departments"] == before + 1
+        assert versions["brand_new"] == 1
+    finally:
+        session.close()
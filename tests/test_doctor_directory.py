@@ -0,0 +1,29 @@
+from conftest import hms
+
+
+def listed_ids():
+    session = hms.SessionLocal()
+    try:
+        return [entry.id for entry in hms.doctor_directory.search(session)]
+    finally:
+        session.close()
+
+
+def test_search_stays_in_id_order_after_refresh(fresh_app, seed, login):
+    fresh_app()
+    doctors, _ = seed(doctors=6, appointments=0)
+    admin = login("admin", "admin123")
+    assert listed_ids() == doctors
+
+    # Deactivating and reactivating re-indexes the doctor through refresh()
+    admin.post(f"/admin/doctor/toggle/{doctors[1]}/inactive")
+    assert listed_ids() == doctors[:1] + doctors[2:]
+    admin.post(f"/admin/doctor/toggle/{doctors[1]}/active")
+    assert listed_ids() == doctors
+
+    session = hms.SessionLocal()
+    try:
+        limited = [entry.id for entry in hms.doctor_directory.search(session, limit=3)]
+    finally:
+        session.close()
+    assert limited == doctors[:3]
@@ -0,0 +1,119 @@
+"""
+Free-slot search: doctors with published hours are found through their
+slot rows, doctors open all day through the days they have no record
+for. The benchmark builds 500 doctors with 30 materialized days each.
+"""
+from datetime import date, time, timedelta
+from statistics import median
+from time import perf_counter
+
+from sqlalchemy import event, insert
+
+from conftest import hms
+
+DOCTORS = 500
+DAYS = 30
+# Per search on the benchmark data; about 7 ms on one slow core
+BUDGET_MS = 100
+
+
+def search(session, **filters):
+    tomorrow = date.today() + timedelta(days=1)
+    return hms.next_free_slots(session, tomorrow, tomorrow + timedelta(days=DAYS), **filters)
+
+
+def test_doctors_open_all_day_are_found(fresh_app, seed):
+    fresh_app()
+    (scheduled, open_all_day, on_leave), (patient_id, *_) = seed(doctors=3, patients=1, appointments=0)
+    tomorrow = date.today() + timedelta(days=1)
+    session = hms.SessionLocal()
+    try:
+        session.add_all([
+            hms.DoctorAvailability(docid=scheduled, available_date=tomorrow, start_time=time(9), end_time=time(12)),
+            hms.DoctorAvailability(docid=on_leave, available_date=tomorrow, available=False),
+        ])
+        hms.materialize_slots(session, scheduled, tomorrow, time(9), time(12))
+        appointment = hms.Appointment(
+            appointment_number="APT-9001", patid=patient_id, docid=open_all_day,
+            appoint_date=tomorrow, appoint_time=time(0), status="Booked",
+        )
+        session.add(appointment)
+        session.flush()
+        assert hms.claim_slot(session, appointment)
+        session.commit()
+
+        slots = search(session, limit=3)
+        assert [(s.doctor_id, s.slot_date, s.slot_time) for s in slots] == [
+            (open_all_day, tomorrow, time(0, 30)),
+            (open_all_day, tomorrow, time(1)),
+            (open_all_day, tomorrow, time(1, 30)),
+        ]
+        morning = [s for s in search(session, limit=100) if s.slot_time == time(9)]
+        assert [s.doctor_id for s in morning] == [scheduled, open_all_day]
+        assert on_leave not in {s.doctor_id for s in search(session, limit=100) if s.slot_date == tomorrow}
+    finally:
+        session.close()
+
+
+def build_schedules(session):
+    """DOCTORS active doctors, each with DAYS days of 09:00-17:00 slots, the
+    first two thirds of the days mostly booked."""
+    departments = [id_ for (id_,) in session.query(hms.Department.id)]
+    session.execute(insert(hms.User), [
+        {"username": f"bench{i}", "password": "-", "name": f"Bench {i}", "role": "doctor"} for i in range(DOCTORS)
+    ])
+    users = [id_ for (id_,) in session.query(hms.User.id).filter(hms.User.username.like("bench%"))]
+    session.execute(insert(hms.Doctor), [
+        {"uid": uid, "depid": departments[i % len(departments)], "specialization": f"S{i % 7}", "status": "active"}
+        for i, uid in enumerate(users)
+    ])
+    doctors = [id_ for (id_,) in session.query(hms.Doctor.id).filter(hms.Doctor.uid.in_(users))]
+
+    today = date.today()
+    days = [today + timedelta(days=offset) for offset in range(DAYS + 1)]
+    times = hms.slot_times(time(9), time(17))
+    session.execute(insert(hms.DoctorAvailability), [
+        {"docid": doctor, "available_date": day, "start_time": time(9), "end_time": time(17), "available": True}
+        for doctor in doctors for day in days
+    ])
+    session.execute(insert(hms.AppointmentSlot), [
+        {"docid": doctor, "slot_date": day, "slot_time": slot, "appointid": 1 if n % 10 and i < 20 else None}
+        for doctor in doctors for i, day in enumerate(days) for n, slot in enumerate(times)
+    ])
+    session.commit()
+    return departments
+
+
+def test_search_cost_with_500_doctors_over_30_days(fresh_app, capsys):
+    fresh_app()
+    session = hms.SessionLocal()
+    try:
+        departments = build_schedules(session)
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        timings = {}
+        for name, filters in (("all", {}), ("department", {"department_id": departments[3]}), ("specialization", {"specialization": "S3"})):
+            runs = []
+            for _ in range(5):
+                started = perf_counter()
+                slots = search(session, **filters)
+                runs.append((perf_counter() - started) * 1000)
+            assert len(slots) == 10
+            timings[name] = median(runs)
+
+        event.listen(hms.engine, "before_cursor_execute", record)
+        try:
+            search(session)
+        finally:
+            event.remove(hms.engine, "before_cursor_execute", record)
+    finally:
+        session.close()
+
+    with capsys.disabled():
+        print("\nfree-slot search, 500 doctors x 30 days:", ", ".join(f"{k} {v:.1f} ms" for k, v in timings.items()))
+    # Every doctor has a record on every day: no open-day walk past day one
+    assert len(statements) <= 2
+    assert max(timings.values()) < BUDGET_MS, timings
@@ -0,0 +1,46 @@
+from conftest import hms
+
+LEGACY_CONDITIONS = "[2024-01-31] Asthma\nmild, seasonal\n[2024-03-02] Hypertension"
+
+
+def add_legacy_history(patient_ids):
+    session = hms.SessionLocal()
+    try:
+        for patient_id in patient_ids:
+            session.add(hms.MedicalHistory(patid=patient_id, chronic_conditions=LEGACY_CONDITIONS, allergies="Penicillin"))
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_migration_is_explicit_keeps_text_and_resumes(fresh_app, seed):
+    fresh_app()
+    _, patients = seed(patients=3, appointments=0)
+    add_legacy_history(patients[:2])
+
+    # init-db leaves legacy history alone
+    hms.initialize_app()
+    session = hms.SessionLocal()
+    try:
+        assert session.query(hms.MedicalHistoryEvent).count() == 0
+        assert hms.pending_history_migration(session)
+
+        assert hms.migrate_medical_history(session, batch_size=1) == 6
+        assert not hms.pending_history_migration(session)
+        # Already copied rows are not copied again
+        assert hms.migrate_medical_history(session) == 0
+        assert session.query(hms.MedicalHistoryEvent).count() == 6
+
+        legacy = session.query(hms.MedicalHistory).order_by(hms.MedicalHistory.id).all()
+        assert [row.chronic_conditions for row in legacy] == [LEGACY_CONDITIONS] * 2
+        assert [row.allergies for row in legacy] == ["Penicillin"] * 2
+    finally:
+        session.close()
+
+    # A patient migrated later is picked up past the marker
+    add_legacy_history(patients[2:])
+    session = hms.SessionLocal()
+    try:
+        assert hms.migrate_medical_history(session) == 3
+    finally:
+        session.close()
@@ -0,0 +1,49 @@
+from sqlalchemy import text
+
+from conftest import hms
+
+
+def walk(client, url, per_page=4):
+    """Ids of every row, following next cursors from page one."""
+    ids, cursor = [], None
+    while True:
+        query = {"per_page": per_page, **({"after": cursor} if cursor else {})}
+        body = client.get(url, query_string=query).get_json()
+        ids += [row["id"] for row in body["data"]]
+        cursor = body["next"]
+        if not cursor:
+            return ids
+
+
+def test_cursors_reach_rows_with_null_sort_columns(fresh_app, seed, login):
+    fresh_app()
+    seed(doctors=2, patients=3, appointments=15)
+    session = hms.SessionLocal()
+    try:
+        session.execute(hms.update(hms.Appointment).where(hms.Appointment.id % 4 == 0).values(appoint_date=None))
+        session.execute(hms.update(hms.Appointment).where(hms.Appointment.id % 5 == 0).values(appoint_time=None))
+        session.execute(hms.update(hms.Treatment).where(hms.Treatment.id % 2 == 0).values(treatment_date=None))
+        session.commit()
+        appointments = {id_ for (id_,) in session.query(hms.Appointment.id)}
+        treatments = {id_ for (id_,) in session.query(hms.Treatment.id)}
+    finally:
+        session.close()
+
+    admin = login("admin", "admin123")
+    for url, expected in (("appointments", appointments), ("treatments", treatments)):
+        ids = walk(admin, f"{hms.API_PREFIX}/{url}")
+        assert len(ids) == len(set(ids))
+        assert set(ids) == expected
+
+
+def test_init_db_replaces_indexes_whose_definition_changed(fresh_app):
+    fresh_app()
+    with hms.engine.begin() as conn:
+        # An index from before the slot index became partial
+        conn.execute(text("CREATE INDEX ix_appointment_slot_appointid ON appointment_slot (appointid)"))
+        conn.execute(text("DROP INDEX ix_appointment_slot_booked"))
+    hms.initialize_app()
+    with hms.engine.connect() as conn:
+        names = hms.index_names(conn, "appointment_slot")
+    assert "ix_appointment_slot_appointid" not in names
+    assert "ix_appointment_slot_booked" in names
@@ -0,0 +1,90 @@
+"""
+Per-route metrics: the log-bucket histogram and its percentiles, nested
+template timing and samples of streamed responses.
+"""
+import pytest
+
+from conftest import hms
+
+
+def test_buckets_grow_by_the_ratio():
+    assert hms.perf_bucket(0) == 0
+    assert hms.perf_bucket(hms.PERF_BUCKET_BASE) == 0
+    for index in (1, 10, 50):
+        bound = hms.PERF_BUCKET_BASE * hms.PERF_BUCKET_RATIO ** index
+        assert hms.perf_bucket(bound * 0.999) == index
+        assert hms.perf_bucket(bound * 1.001) == index + 1
+    # Values past the last bound share the last bucket
+    assert hms.perf_bucket(1e12) == hms.PERF_BUCKETS - 1
+
+
+def record(stats, values):
+    for value in values:
+        sample = hms.RequestSample(stats)
+        sample.wall_ms = value
+        stats.record(sample)
+
+
+def test_percentiles_are_bucket_bounds_capped_at_the_maximum():
+    stats = hms.RouteStats()
+    assert stats.percentile("wall_ms", 0.5) is None
+    assert stats.mean("wall_ms") is None
+
+    record(stats, [1.0] * 90 + [100.0] * 9 + [1000.0])
+    assert stats.count("wall_ms") == 100
+    assert stats.mean("wall_ms") == pytest.approx((90 + 900 + 1000) / 100)
+
+    # Each percentile is the upper bound of its bucket: within one ratio step
+    p50 = stats.percentile("wall_ms", 0.5)
+    assert 1.0 <= p50 < hms.PERF_BUCKET_RATIO
+    p95 = stats.percentile("wall_ms", 0.95)
+    assert 100.0 <= p95 < 100.0 * hms.PERF_BUCKET_RATIO
+    # The top bucket's bound is past the largest value seen
+    assert stats.percentile("wall_ms", 1.0) == 1000.0
+
+
+def test_merged_histograms_give_the_same_percentiles():
+    left, right, whole = hms.RouteStats(), hms.RouteStats(), hms.RouteStats()
+    values = [0.5 * i for i in range(1, 201)]
+    record(left, values[::2])
+    record(right, values[1::2])
+    record(whole, values)
+    left.merge(right)
+    for fraction in (0.5, 0.9, 0.99):
+        assert left.percentile("wall_ms", fraction) == whole.percentile("wall_ms", fraction)
+    assert left.maxima["wall_ms"] == whole.maxima["wall_ms"] == 100.0
+
+
+def test_nested_renders_count_once(monkeypatch):
+    clock = iter([0.0, 0.010, 0.030, 0.050])
+    monkeypatch.setattr(hms, "perf_counter", lambda: next(clock))
+    sample = hms.RequestSample(hms.RouteStats())
+    monkeypatch.setattr(hms._perf_local, "sample", sample, raising=False)
+
+    hms.start_template_timer(None, "outer", {})
+    hms.start_template_timer(None, "inner", {})
+    hms.stop_template_timer(None, "inner", {})
+    assert sample.render_ms == 0
+    hms.stop_template_timer(None, "outer", {})
+    assert sample.render_ms == pytest.approx(40.0)
+
+
+def test_streamed_export_is_recorded_after_its_body(fresh_app, seed, login):
+    fresh_app()
+    seed(appointments=30)
+    hms.create_app({"PERF_ENABLED": True})
+    hms.reset_perf_stats()
+    admin = login("admin", "admin123")
+
+    response = admin.get("/admin/export/appointments", buffered=False)
+    assert response.is_streamed
+    assert hms.perf_snapshot()["admin_export"].requests == 0
+    body = response.get_data()
+    response.close()
+
+    stats = hms.perf_snapshot()["admin_export"]
+    assert stats.requests == 1
+    assert body.count(b"\n") == 31
+    # The export's queries run while the body streams
+    assert stats.totals["sql_count"] >= 1
+    assert stats.totals["rows"] >= 30
@@ -0,0 +1,85 @@
+"""
+List pages must issue a fixed number of SQL statements however many rows
+they show. Every route is rendered against a small and a five times
+larger database and the statement counts compared.
+"""
+import pytest
+from sqlalchemy import event
+
+from conftest import hms
+
+# Generous ceiling; an N+1 regression blows through it at the large size
+MAX_STATEMENTS = 15
+
+ROUTES = {
+    "admin": [
+        "/admin/dashboard",
+        "/admin/doctors",
+        "/admin/patients",
+        "/admin/appointments",
+        "/admin/treatments",
+        "/admin/reports",
+        "/admin/departments",
+        "/admin/patient/{patient}/treatments",
+        "/admin/search/results?search_type=doctor&search_term=Doctor",
+        "/admin/search/results?search_type=patient&search_term=Patient",
+        "/admin/search/results?search_type=appointment&search_term=APT",
+    ],
+    "doc0": [
+        "/doctor/dashboard",
+        "/doctor/appointments",
+        "/doctor/patients",
+        "/doctor/treatments",
+        "/doctor/patient/history/{patient}",
+    ],
+    "pat0": [
+        "/patient/dashboard",
+        "/patient/appointments",
+        "/patient/doctors",
+        "/patient/appointments/book",
+        "/patient/treatments",
+        "/patient/history",
+    ],
+}
+ALL_ROUTES = [(user, url) for user, urls in ROUTES.items() for url in urls]
+
+
+def statement_counts(fresh_app, seed, login, scale):
+    """{(user, url): statements} for every route at the given data scale."""
+    fresh_app()
+    _, patients = seed(doctors=3 * scale, patients=5 * scale, appointments=30 * scale)
+    clients = {user: login(user, "admin123" if user == "admin" else "pw") for user in ROUTES}
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    counts = {}
+    event.listen(hms.engine, "before_cursor_execute", count)
+    try:
+        for user, url in ALL_ROUTES:
+            statements.clear()
+            response = clients[user].get(url.format(patient=patients[0]))
+            assert response.status_code == 200, f"{url} answered {response.status_code}"
+            counts[user, url] = len(statements)
+    finally:
+        event.remove(hms.engine, "before_cursor_execute", count)
+    return counts
+
+
+@pytest.fixture
+def counts(fresh_app, seed, login):
+    return statement_counts(fresh_app, seed, login, 1), statement_counts(fresh_app, seed, login, 5)
+
+
+def test_statement_count_does_not_grow_with_rows(counts):
+    small, large = counts
+    grown = {route: (small[route], large[route]) for route in small if large[route] > small[route]}
+    assert not grown, f"statement count grows with row count: {grown}"
+
+
+def test_statement_count_is_bounded(counts):
+    _, large = counts
+    over = {route: count for route, count in large.items() if count > MAX_STATEMENTS}
+    assert not over, f"more than {MAX_STATEMENTS} statements: {over}"
@@ -0,0 +1,30 @@
+"""
+Startup budget. Each probe is a fresh interpreter, so nothing is imported
+or warm. Flask and SQLAlchemy alone can take longer than the whole budget
+on a slow core, so the budget test covers what a preloading server pays
+per worker, and check-startup must not pass a full cold start that it
+cannot afford.
+"""
+import pytest
+
+from conftest import hms
+
+
+@pytest.fixture(scope="module")
+def timing():
+    # Scheduling noise only ever adds time; keep the fastest of three
+    return min((hms.probe_startup() for _ in range(3)), key=hms.startup_total)
+
+
+def test_preloaded_worker_start_is_within_budget(timing):
+    assert timing["status"] == 200
+    assert hms.startup_total(timing, preloaded=True) <= hms.STARTUP_BUDGET_MS, timing
+
+
+def test_cold_start_counts_library_imports(timing):
+    runner = hms.app.test_cli_runner()
+    budget = int(timing["libraries_ms"]) // 2
+    result = runner.invoke(args=["check-startup", "--runs", "1", "--budget-ms", str(budget)])
+    assert result.exit_code != 0
+    assert "[SUCCESS]" not in result.output
+    assert "over the" in result.output
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from conftest import hms
+
+# Well-formed cursors (valid base64 JSON of three values) of the wrong shape
+BAD_CURSORS = [
+    [None, 0, 1],
+    ["2024-01-01T09:00:00", None, 1],
+    ["2024-01-01T09:00:00", 7, 1],
+    ["2024-01-01T09:00:00", 0, "1"],
+    ["2024-01-01T09:00:00", True, 1],
+    ["2024-01-01T09:00:00", 0, 2**70],
+    ["2024-01-01T09:00:00", 0.5, 1],
+    [[], 0, 1],
+]
+
+
+@pytest.fixture
+def patient(fresh_app, seed, login):
+    fresh_app()
+    _, (patient_id, *_) = seed(doctors=2, patients=3, appointments=30)
+    return patient_id, login("pat0")
+
+
+@pytest.mark.parametrize("values", BAD_CURSORS, ids=json.dumps)
+def test_malformed_cursor_restarts_from_newest(patient, values):
+    patient_id, client = patient
+    cursor = hms.encode_cursor(values)
+    url = f"{hms.API_PREFIX}/patients/{patient_id}/timeline"
+
+    first = client.get(url).get_json()
+    response = client.get(url, query_string={"after": cursor})
+    assert response.status_code == 200
+    assert response.get_json()["data"] == first["data"]
+
+    assert client.get("/patient/history", query_string={"after": cursor}).status_code == 200
+
+
+def test_next_cursor_still_pages(patient):
+    patient_id, client = patient
+    url = f"{hms.API_PREFIX}/patients/{patient_id}/timeline"
+    first = client.get(url, query_string={"per_page": 3}).get_json()
+    second = client.get(url, query_string={"per_page": 3, "after": first["next"]}).get_json()
+    assert second["data"] and second["data"][0] != first["data"][0]
+
+
+def test_undated_rows_come_last_on_every_page(patient):
+    patient_id, client = patient
+    session = hms.SessionLocal()
+    try:
+        session.execute(hms.update(hms.Appointment).where(
+            hms.Appointment.patid == patient_id, hms.Appointment.id % 2 == 0,
+        ).values(appoint_date=None))
+        session.execute(hms.update(hms.Treatment).where(hms.Treatment.patid == patient_id).values(treatment_date=None))
+        session.commit()
+        appointments = session.query(hms.Appointment).filter_by(patid=patient_id).count()
+        treatments = session.query(hms.Treatment).filter_by(patid=patient_id).count()
+    finally:
+        session.close()
+
+    url = f"{hms.API_PREFIX}/patients/{patient_id}/timeline"
+    entries, cursor = [], None
+    while True:
+        body = client.get(url, query_string={"per_page": 3, **({"after": cursor} if cursor else {})}).get_json()
+        entries += body["data"]
+        cursor = body["next"]
+        if not cursor:
+            break
+    assert len(entries) == appointments + treatments
+    dated = [entry["at"] is not None for entry in entries]
+    assert dated == sorted(dated, reverse=True) and not all(dated)
+    assert client.get("/patient/history").status_code == 200